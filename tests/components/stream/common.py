@@ -1,7 +1,7 @@
 """Collection of test helpers."""
 from datetime import datetime
 from fractions import Fraction
-from functools import partial
+from functools import lru_cache, partial
 import io
 
 import av
@@ -38,9 +38,19 @@ def generate_audio_frame(pcm_mulaw=False):
 
 
 def generate_h264_video(container_format="mp4", duration=5):
+    """Return a test video as a new file-like object."""
+    output = io.BytesIO(_encode_h264_video(container_format, duration))
+    output.name = "test.mov" if container_format == "mov" else "test.mp4"
+    return output
+
+
+@lru_cache(maxsize=4)
+def _encode_h264_video(container_format, duration):
     """
     Generate a test video.
 
+    The encoded bytes are cached so each video is only encoded once.
+
     See: http://docs.mikeboers.com/pyav/develop/cookbook/numpy.html
     """
 
@@ -77,9 +87,8 @@ def generate_h264_video(container_format="mp4", duration=5):
 
     # Close the file
     container.close()
-    output.seek(0)
 
-    return output
+    return output.getvalue()
 
 
 def remux_with_audio(source, container_format, audio_codec):
@@ -67,6 +67,9 @@ def stream_worker_sync(hass):
         autospec=True,
     ):
         yield sync
+        # Release a worker left paused by a failed test so teardown can finish
+        if sync._event:
+            sync.resume()
 
 
 class SaveRecordWorkerSync:
@@ -1,7 +1,11 @@
 """The tests for hls streams."""
 import asyncio
+from functools import lru_cache
 import itertools
+import math
 import re
+import struct
+from typing import Final
 from urllib.parse import urlparse
 
 import pytest
@@ -27,14 +31,20 @@ from tests.components.stream.common import (
     generate_h264_video,
 )
 
-TEST_PART_DURATION = 1
-NUM_PART_SEGMENTS = int(-(-SEGMENT_DURATION // TEST_PART_DURATION))
-PART_INDEPENDENT_PERIOD = int(1 / TEST_PART_DURATION) or 1
-BYTERANGE_LENGTH = 1
+TEST_PART_DURATION: Final = 1
+NUM_PART_SEGMENTS: Final = math.ceil(SEGMENT_DURATION / TEST_PART_DURATION)
+PART_INDEPENDENT_PERIOD: Final = int(1 / TEST_PART_DURATION) or 1
+BYTERANGE_LENGTH: Final = 1
 INIT_BYTES = b"init"
-SEQUENCE_BYTES = bytearray(range(NUM_PART_SEGMENTS * BYTERANGE_LENGTH))
-ALT_SEQUENCE_BYTES = bytearray(range(20, 20 + NUM_PART_SEGMENTS * BYTERANGE_LENGTH))
-VERY_LARGE_LAST_BYTE_POS = 9007199254740991
+SEQUENCE_BYTES = bytes(range(NUM_PART_SEGMENTS * BYTERANGE_LENGTH))
+ALT_SEQUENCE_BYTES = bytes(range(20, 20 + NUM_PART_SEGMENTS * BYTERANGE_LENGTH))
+VERY_LARGE_LAST_BYTE_POS: Final = 9007199254740991
+UINT32_BE = struct.Struct(">I")
+SEGMENT_RE = re.compile(r"^(?P<segment_url>./segment/\d+\.m4s)", re.MULTILINE)
+PART_RE = re.compile(
+    r'^#EXT-X-PART:DURATION=\d+\.\d{3},URI="(?P<part_url>.+?)",BYTERANGE="(?P<byterange_length>\d+)@(?P<byterange_start>\d+)"(,INDEPENDENT=YES)?',
+    re.MULTILINE,
+)
 
 
 @pytest.fixture
@@ -50,6 +60,22 @@ def hls_stream(hass, hass_client):
     return create_client_for_stream
 
 
+@pytest.fixture
+async def ll_hls_component(hass):
+    """Set up the stream component with LL-HLS enabled."""
+    await async_setup_component(
+        hass,
+        "stream",
+        {
+            "stream": {
+                CONF_LL_HLS: True,
+                CONF_SEGMENT_DURATION: SEGMENT_DURATION,
+                CONF_PART_DURATION: TEST_PART_DURATION,
+            }
+        },
+    )
+
+
 def create_segment(sequence):
     """Create an empty segment."""
     segment = Segment(sequence=sequence)
@@ -66,17 +92,50 @@ def complete_segment(segment):
 
 def create_parts(source):
     """Create parts from a source."""
-    independent_cycle = itertools.cycle(
-        [True] + [False] * (PART_INDEPENDENT_PERIOD - 1)
-    )
-    return [
+    return list(_create_parts(source))
+
+
+@lru_cache(maxsize=4)
+def _create_parts(source):
+    """Create an immutable, cached sequence of parts from a source."""
+    view = memoryview(source)
+    return tuple(
         Part(
             duration=TEST_PART_DURATION,
-            has_keyframe=next(independent_cycle),
-            data=bytes(source[i * BYTERANGE_LENGTH : (i + 1) * BYTERANGE_LENGTH]),
+            has_keyframe=i % PART_INDEPENDENT_PERIOD == 0,
+            data=bytes(view[i * BYTERANGE_LENGTH : (i + 1) * BYTERANGE_LENGTH]),
         )
         for i in range(NUM_PART_SEGMENTS)
-    ]
+    )
+
+
+@pytest.fixture
+def seeded_hls(hass, stream_worker_sync, ll_hls_component):
+    """Create an HLS output seeded with 1 complete and 1 in process segment.
+
+    Returns the stream, the output, the in process segment, the parts not yet
+    added to it and the number of parts already added.
+    """
+    stream = create_stream(hass, STREAM_SOURCE, {})
+    stream_worker_sync.pause()
+
+    hls = stream.add_provider(HLS_PROVIDER)
+
+    segment = create_segment(sequence=0)
+    hls.put(segment)
+    for part in create_parts(SEQUENCE_BYTES):
+        segment.async_add_part(part, 0)
+        hls.part_put()
+    complete_segment(segment)
+
+    segment = create_segment(sequence=1)
+    hls.put(segment)
+    remaining_parts = create_parts(SEQUENCE_BYTES)
+    num_completed_parts = len(remaining_parts) // 2
+    for _ in range(num_completed_parts):
+        segment.async_add_part(remaining_parts.pop(0), 0)
+
+    return stream, hls, segment, remaining_parts, num_completed_parts
 
 
 def http_range_from_part(part):
@@ -88,24 +147,21 @@ def make_segment_with_parts(
     segment, num_parts, independent_period, discontinuity=False
 ):
     """Create a playlist response for a segment including part segments."""
-    response = []
-    for i in range(num_parts):
-        length, start = http_range_from_part(i)
-        response.append(
-            f'#EXT-X-PART:DURATION={TEST_PART_DURATION:.3f},URI="./segment/{segment}.m4s",BYTERANGE="{length}@{start}"{",INDEPENDENT=YES" if i%independent_period==0 else ""}'
-        )
-    if discontinuity:
-        response.append("#EXT-X-DISCONTINUITY")
-    response.extend(
-        [
-            "#EXT-X-PROGRAM-DATE-TIME:"
-            + FAKE_TIME.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
-            + "Z",
-            f"#EXTINF:{SEGMENT_DURATION:.3f},",
-            f"./segment/{segment}.m4s",
-        ]
+    independent = (",INDEPENDENT=YES", "")
+    part_lines = (
+        f'#EXT-X-PART:DURATION={TEST_PART_DURATION:.3f},URI="./segment/{segment}.m4s",BYTERANGE="{BYTERANGE_LENGTH}@{i * BYTERANGE_LENGTH}"{independent[i % independent_period != 0]}'
+        for i in range(num_parts)
     )
-    return "\n".join(response)
+    extra_lines = [
+        "#EXT-X-PROGRAM-DATE-TIME:"
+        + FAKE_TIME.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+        + "Z",
+        f"#EXTINF:{SEGMENT_DURATION:.3f},",
+        f"./segment/{segment}.m4s",
+    ]
+    if discontinuity:
+        extra_lines.insert(0, "#EXT-X-DISCONTINUITY")
+    return "\n".join(itertools.chain(part_lines, extra_lines))
 
 
 def make_hint(segment, part):
@@ -114,25 +170,13 @@ def make_hint(segment, part):
     return f'#EXT-X-PRELOAD-HINT:TYPE=PART,URI="./segment/{segment}.m4s",BYTERANGE-START={start}'
 
 
-async def test_ll_hls_stream(hass, hls_stream, stream_worker_sync):
+async def test_ll_hls_stream(hass, hls_stream, stream_worker_sync, ll_hls_component):
     """
     Test hls stream.
 
     Purposefully not mocking anything here to test full
     integration with the stream component.
     """
-    await async_setup_component(
-        hass,
-        "stream",
-        {
-            "stream": {
-                CONF_LL_HLS: True,
-                CONF_SEGMENT_DURATION: SEGMENT_DURATION,
-                CONF_PART_DURATION: TEST_PART_DURATION,
-            }
-        },
-    )
-
     stream_worker_sync.pause()
 
     # Setup demo HLS track
@@ -161,51 +205,51 @@ async def test_ll_hls_stream(hass, hls_stream, stream_worker_sync):
 
     # Fetch segments
     playlist = await playlist_response.text()
-    segment_re = re.compile(r"^(?P<segment_url>./segment/\d+\.m4s)")
-    for line in playlist.splitlines():
-        match = segment_re.match(line)
-        if match:
-            segment_url = "/" + match.group("segment_url")
-            segment_response = await hls_client.get(segment_url)
-            assert segment_response.status == 200
+    segment_urls = [
+        "/" + match.group("segment_url") for match in SEGMENT_RE.finditer(playlist)
+    ]
+    assert segment_urls
+    segment_responses = await asyncio.gather(
+        *(hls_client.get(segment_url) for segment_url in segment_urls)
+    )
+    assert all(response.status == 200 for response in segment_responses)
 
     def check_part_is_moof_mdat(data: bytes):
         if len(data) < 8 or data[4:8] != b"moof":
             return False
-        moof_length = int.from_bytes(data[0:4], byteorder="big")
-        if (
-            len(data) < moof_length + 8
-            or data[moof_length + 4 : moof_length + 8] != b"mdat"
-        ):
-            return False
-        mdat_length = int.from_bytes(
-            data[moof_length : moof_length + 4], byteorder="big"
+        moof_length = UINT32_BE.unpack_from(data, 0)[0]
+        return (
+            len(data) >= moof_length + 8
+            and data[moof_length + 4 : moof_length + 8] == b"mdat"
+            and UINT32_BE.unpack_from(data, moof_length)[0] + moof_length == len(data)
         )
-        if mdat_length + moof_length != len(data):
-            return False
-        return True
 
     # Fetch all completed part segments
-    part_re = re.compile(
-        r'#EXT-X-PART:DURATION=[0-9].[0-9]{5,5},URI="(?P<part_url>.+?)",BYTERANGE="(?P<byterange_length>[0-9]+?)@(?P<byterange_start>[0-9]+?)"(,INDEPENDENT=YES)?'
-    )
-    for line in playlist.splitlines():
-        match = part_re.match(line)
-        if match:
-            part_segment_url = "/" + match.group("part_url")
-            byterange_end = (
-                int(match.group("byterange_length"))
-                + int(match.group("byterange_start"))
-                - 1
-            )
-            part_segment_response = await hls_client.get(
+    part_requests = []
+    for match in PART_RE.finditer(playlist):
+        part_segment_url = "/" + match.group("part_url")
+        byterange_end = (
+            int(match.group("byterange_length"))
+            + int(match.group("byterange_start"))
+            - 1
+        )
+        part_requests.append(
+            (
                 part_segment_url,
-                headers={
-                    "Range": f'bytes={match.group("byterange_start")}-{byterange_end}'
-                },
+                {"Range": f'bytes={match.group("byterange_start")}-{byterange_end}'},
             )
-            assert part_segment_response.status == 206
-            assert check_part_is_moof_mdat(await part_segment_response.read())
+        )
+    assert part_requests
+    part_segment_responses = await asyncio.gather(
+        *(hls_client.get(url, headers=headers) for url, headers in part_requests)
+    )
+    assert all(response.status == 206 for response in part_segment_responses)
+    part_segments = await asyncio.gather(
+        *(response.read() for response in part_segment_responses)
+    )
+    assert all(check_part_is_moof_mdat(data) for data in part_segments)
+    # A truncated part no longer matches the mdat length in its header
+    assert not check_part_is_moof_mdat(part_segments[0][:-1])
 
     stream_worker_sync.resume()
 
@@ -217,20 +261,10 @@ async def test_ll_hls_stream(hass, hls_stream, stream_worker_sync):
     assert fail_response.status == HTTP_NOT_FOUND
 
 
-async def test_ll_hls_playlist_view(hass, hls_stream, stream_worker_sync):
+async def test_ll_hls_playlist_view(
+    hass, hls_stream, stream_worker_sync, ll_hls_component
+):
     """Test rendering the hls playlist with 1 and 2 output segments."""
-    await async_setup_component(
-        hass,
-        "stream",
-        {
-            "stream": {
-                CONF_LL_HLS: True,
-                CONF_SEGMENT_DURATION: SEGMENT_DURATION,
-                CONF_PART_DURATION: TEST_PART_DURATION,
-            }
-        },
-    )
-
     stream = create_stream(hass, STREAM_SOURCE, {})
     stream_worker_sync.pause()
     hls = stream.add_provider(HLS_PROVIDER)
@@ -288,20 +322,10 @@ async def test_ll_hls_playlist_view(hass, hls_stream, stream_worker_sync):
     stream.stop()
 
 
-async def test_ll_hls_msn(hass, hls_stream, stream_worker_sync, hls_sync):
+async def test_ll_hls_msn(
+    hass, hls_stream, stream_worker_sync, hls_sync, ll_hls_component
+):
     """Test that requests using _HLS_msn get held and returned or rejected."""
-    await async_setup_component(
-        hass,
-        "stream",
-        {
-            "stream": {
-                CONF_LL_HLS: True,
-                CONF_SEGMENT_DURATION: SEGMENT_DURATION,
-                CONF_PART_DURATION: TEST_PART_DURATION,
-            }
-        },
-    )
-
     stream = create_stream(hass, STREAM_SOURCE, {})
     stream_worker_sync.pause()
 
@@ -324,10 +348,7 @@ async def test_ll_hls_msn(hass, hls_stream, stream_worker_sync, hls_sync):
 
     msn_responses = await msn_requests
 
-    assert msn_responses[0].status == 200
-    assert msn_responses[1].status == 200
-    assert msn_responses[2].status == 400
-    assert msn_responses[3].status == 400
+    assert tuple(response.status for response in msn_responses) == (200, 200, 400, 400)
 
     # Sequence number is now 2. Create six more requests for sequences 0 through 5.
     # Calls for msn 0 through 4 should work, 5 should fail.
@@ -342,35 +363,17 @@ async def test_ll_hls_msn(hass, hls_stream, stream_worker_sync, hls_sync):
         hls.put(segment)
 
     msn_responses = await msn_requests
-    assert msn_responses[0].status == 200
-    assert msn_responses[1].status == 200
-    assert msn_responses[2].status == 200
-    assert msn_responses[3].status == 200
-    assert msn_responses[4].status == 200
-    assert msn_responses[5].status == 400
+    assert tuple(response.status for response in msn_responses) == (200,) * 5 + (400,)
 
     stream_worker_sync.resume()
 
 
-async def test_ll_hls_playlist_bad_msn_part(hass, hls_stream, stream_worker_sync):
+async def test_ll_hls_playlist_bad_msn_part(
+    hass, hls_stream, stream_worker_sync, seeded_hls
+):
     """Test some playlist requests with invalid _HLS_msn/_HLS_part."""
 
-    await async_setup_component(
-        hass,
-        "stream",
-        {
-            "stream": {
-                CONF_LL_HLS: True,
-                CONF_SEGMENT_DURATION: SEGMENT_DURATION,
-                CONF_PART_DURATION: TEST_PART_DURATION,
-            }
-        },
-    )
-
-    stream = create_stream(hass, STREAM_SOURCE, {})
-    stream_worker_sync.pause()
-
-    hls = stream.add_provider(HLS_PROVIDER)
+    stream, _, _, _, num_completed_parts = seeded_hls
 
     hls_client = await hls_stream(stream)
 
@@ -379,21 +382,6 @@ async def test_ll_hls_playlist_bad_msn_part(hass, hls_stream, stream_worker_sync
 
     assert (await hls_client.get("/playlist.m3u8?_HLS_part=1")).status == 400
 
-    # Seed hls with 1 complete segment and 1 in process segment
-    segment = create_segment(sequence=0)
-    hls.put(segment)
-    for part in create_parts(SEQUENCE_BYTES):
-        segment.async_add_part(part, 0)
-        hls.part_put()
-    complete_segment(segment)
-
-    segment = create_segment(sequence=1)
-    hls.put(segment)
-    remaining_parts = create_parts(SEQUENCE_BYTES)
-    num_completed_parts = len(remaining_parts) // 2
-    for part in remaining_parts[:num_completed_parts]:
-        segment.async_add_part(part, 0)
-
     # If the _HLS_msn is greater than the Media Sequence Number of the last
     # Media Segment in the current Playlist plus two, or if the _HLS_part
     # exceeds the last Partial Segment in the current Playlist by the
@@ -406,32 +394,21 @@ async def test_ll_hls_playlist_bad_msn_part(hass, hls_stream, stream_worker_sync
     # The following two tests should fail immediately:
     # - request with a _HLS_msn of 4
     # - request with a _HLS_msn of 1 and a _HLS_part of num_completed_parts-1+advance_part_limit
+    advance_limit = math.ceil(hass.data[DOMAIN][ATTR_SETTINGS].hls_advance_part_limit)
     assert (await hls_client.get("/playlist.m3u8?_HLS_msn=4")).status == 400
     assert (
         await hls_client.get(
-            f"/playlist.m3u8?_HLS_msn=1&_HLS_part={num_completed_parts-1+hass.data[DOMAIN][ATTR_SETTINGS].hls_advance_part_limit}"
+            f"/playlist.m3u8?_HLS_msn=1&_HLS_part={num_completed_parts-1+advance_limit}"
         )
     ).status == 400
     stream_worker_sync.resume()
 
 
 async def test_ll_hls_playlist_rollover_part(
-    hass, hls_stream, stream_worker_sync, hls_sync
+    hass, hls_stream, stream_worker_sync, hls_sync, ll_hls_component
 ):
     """Test playlist request rollover."""
 
-    await async_setup_component(
-        hass,
-        "stream",
-        {
-            "stream": {
-                CONF_LL_HLS: True,
-                CONF_SEGMENT_DURATION: SEGMENT_DURATION,
-                CONF_PART_DURATION: TEST_PART_DURATION,
-            }
-        },
-    )
-
     stream = create_stream(hass, STREAM_SOURCE, {})
     stream_worker_sync.pause()
 
@@ -496,56 +473,22 @@ async def test_ll_hls_playlist_rollover_part(
     stream_worker_sync.resume()
 
 
-async def test_ll_hls_playlist_msn_part(hass, hls_stream, stream_worker_sync, hls_sync):
+async def test_ll_hls_playlist_msn_part(
+    hass, hls_stream, stream_worker_sync, hls_sync, seeded_hls
+):
     """Test that requests using _HLS_msn and _HLS_part get held and returned."""
 
-    await async_setup_component(
-        hass,
-        "stream",
-        {
-            "stream": {
-                CONF_LL_HLS: True,
-                CONF_SEGMENT_DURATION: SEGMENT_DURATION,
-                CONF_PART_DURATION: TEST_PART_DURATION,
-            }
-        },
-    )
-
-    stream = create_stream(hass, STREAM_SOURCE, {})
-    stream_worker_sync.pause()
-
-    hls = stream.add_provider(HLS_PROVIDER)
+    stream, hls, segment, remaining_parts, num_completed_parts = seeded_hls
 
     hls_client = await hls_stream(stream)
 
-    # Seed hls with 1 complete segment and 1 in process segment
-    segment = create_segment(sequence=0)
-    hls.put(segment)
-    for part in create_parts(SEQUENCE_BYTES):
-        segment.async_add_part(part, 0)
-        hls.part_put()
-    complete_segment(segment)
-
-    segment = create_segment(sequence=1)
-    hls.put(segment)
-    remaining_parts = create_parts(SEQUENCE_BYTES)
-    num_completed_parts = len(remaining_parts) // 2
-    for part in remaining_parts[:num_completed_parts]:
-        segment.async_add_part(part, 0)
-    del remaining_parts[:num_completed_parts]
-
     # Make requests for all the part segments up to n+ADVANCE_PART_LIMIT
-    hls_sync.reset_request_pool(
-        num_completed_parts
-        + int(-(-hass.data[DOMAIN][ATTR_SETTINGS].hls_advance_part_limit // 1))
-    )
+    advance_limit = math.ceil(hass.data[DOMAIN][ATTR_SETTINGS].hls_advance_part_limit)
+    hls_sync.reset_request_pool(num_completed_parts + advance_limit)
     msn_requests = asyncio.gather(
         *(
             hls_client.get(f"/playlist.m3u8?_HLS_msn=1&_HLS_part={i}")
-            for i in range(
-                num_completed_parts
-                + int(-(-hass.data[DOMAIN][ATTR_SETTINGS].hls_advance_part_limit // 1))
-            )
+            for i in range(num_completed_parts + advance_limit)
         )
     )
 
@@ -557,79 +500,39 @@ async def test_ll_hls_playlist_msn_part(hass, hls_stream, stream_worker_sync, hl
     msn_responses = await msn_requests
 
     # All the responses should succeed except the last one which fails
-    assert all(response.status == 200 for response in msn_responses[:-1])
-    assert msn_responses[-1].status == 400
+    statuses = tuple(response.status for response in msn_responses)
+    assert statuses == (200,) * (len(statuses) - 1) + (400,)
 
     stream_worker_sync.resume()
 
 
-async def test_get_part_segments(hass, hls_stream, stream_worker_sync, hls_sync):
+async def test_get_part_segments(
+    hass, hls_stream, stream_worker_sync, hls_sync, seeded_hls
+):
     """Test requests for part segments and hinted parts."""
-    await async_setup_component(
-        hass,
-        "stream",
-        {
-            "stream": {
-                CONF_LL_HLS: True,
-                CONF_SEGMENT_DURATION: SEGMENT_DURATION,
-                CONF_PART_DURATION: TEST_PART_DURATION,
-            }
-        },
-    )
-
-    stream = create_stream(hass, STREAM_SOURCE, {})
-    stream_worker_sync.pause()
-
-    hls = stream.add_provider(HLS_PROVIDER)
+    stream, hls, segment, remaining_parts, num_completed_parts = seeded_hls
 
     hls_client = await hls_stream(stream)
 
-    # Seed hls with 1 complete segment and 1 in process segment
-    segment = create_segment(sequence=0)
-    hls.put(segment)
-    for part in create_parts(SEQUENCE_BYTES):
-        segment.async_add_part(part, 0)
-        hls.part_put()
-    complete_segment(segment)
-
-    segment = create_segment(sequence=1)
-    hls.put(segment)
-    remaining_parts = create_parts(SEQUENCE_BYTES)
-    num_completed_parts = len(remaining_parts) // 2
-    for _ in range(num_completed_parts):
-        segment.async_add_part(remaining_parts.pop(0), 0)
-
     # Make requests for all the existing part segments
     # These should succeed with a status of 206
+    ranges = [http_range_from_part(part) for part in range(num_completed_parts)]
     requests = asyncio.gather(
         *(
             hls_client.get(
-                "/segment/1.m4s",
-                headers={
-                    "Range": f"bytes={http_range_from_part(part)[1]}-"
-                    + str(
-                        http_range_from_part(part)[0]
-                        + http_range_from_part(part)[1]
-                        - 1
-                    )
-                },
+                "/segment/1.m4s", headers={"Range": f"bytes={start}-{start+length-1}"}
             )
-            for part in range(num_completed_parts)
+            for length, start in ranges
         )
     )
     responses = await requests
     assert all(response.status == 206 for response in responses)
-    assert all(
-        responses[part].headers["Content-Range"]
-        == f"bytes {http_range_from_part(part)[1]}-"
-        + str(http_range_from_part(part)[0] + http_range_from_part(part)[1] - 1)
-        + "/*"
-        for part in range(num_completed_parts)
-    )
+    assert [response.headers["Content-Range"] for response in responses] == [
+        f"bytes {start}-{start+length-1}/*" for length, start in ranges
+    ]
     parts = list(segment.parts_by_byterange.values())
-    assert all(
-        [await responses[i].read() == parts[i].data for i in range(len(responses))]
-    )
+    bodies = await asyncio.gather(*(response.read() for response in responses))
+    assert all(bodies[i] == parts[i].data for i in range(len(bodies)))
 
     # Make some non standard range requests.
     # Request past end of previous closed segment
@@ -723,9 +626,9 @@ async def test_get_part_segments(hass, hls_stream, stream_worker_sync, hls_sync)
     )
     assert responses[1].status == 200
     assert "Content-Range" not in responses[1].headers
-    assert (
-        await response.read() == ALT_SEQUENCE_BYTES[: hls.get_segment(2).data_size]
-        for response in responses
+    bodies = await asyncio.gather(*(response.read() for response in responses))
+    assert all(
+        body == ALT_SEQUENCE_BYTES[: hls.get_segment(2).data_size] for body in bodies
     )
 
     stream_worker_sync.resume()